@@ -1,8 +1,38 @@
 import streamlit as st
-import gspread
-import google.generativeai as genai
-from google.oauth2.service_account import Credentials
-from datetime import datetime
+import collections
+import logging
+import threading
+import time
+import types
+import uuid
+import weakref
+from datetime import timedelta
+from sheet_logger import start_sheet_logger
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = """You are Dr. Huberman AI, an assistant modeled on the style of Dr. Andrew Huberman.
+You answer questions about neuroscience, habits, sleep, focus, exercise, and health.
+Explain the underlying biology in clear, plain language, and finish with practical,
+science-based protocols the user can try. You are not a doctor: for medical
+conditions, medications, or emergencies, tell the user to consult a qualified professional."""
+
+GS_SCOPES = (
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.file"
+)
+
+# Max messages kept in st.session_state.chat_history for display
+HISTORY_WINDOW = 40
+# Past this many messages, history renders as one markdown blob per role
+COMPACT_HISTORY_AFTER = 20
+
+GEMINI_MODEL_NAME = "models/gemini-pro-latest"
+# Lifetime of the server-side SYSTEM_PROMPT cache, renewed while the app runs
+CONTEXT_CACHE_TTL = timedelta(hours=1)
+# Smallest content explicit context caching accepts on current models; the
+# model's own limit may be higher, in which case CachedContent.create refuses
+CONTEXT_CACHE_MIN_TOKENS = 1024
 
 # -----------------------------------------------------------------
 # 1. SETUP - Page Config and Secrets
@@ -17,9 +47,15 @@ st.set_page_config(
 # Load secrets from Streamlit's secrets manager
 try:
     GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
-    SERVICE_ACCOUNT_JSON = st.secrets["SERVICE_ACCOUNT_JSON"]
+    # Read-only view so nothing downstream can mutate the credentials
+    SERVICE_ACCOUNT_JSON = types.MappingProxyType(dict(st.secrets["SERVICE_ACCOUNT_JSON"]))
+    # Display-only, so a missing field shouldn't stop the app
+    PROJECT_ID = SERVICE_ACCOUNT_JSON.get("project_id", "<missing project_id>")
+    CLIENT_EMAIL = SERVICE_ACCOUNT_JSON.get("client_email", "<missing client_email>")
     SHEET_ID = st.secrets["SHEET_ID"]
     SHEET_NAME = st.secrets.get("SHEET_NAME", "ChatTest") 
+    DEBUG = st.secrets.get("DEBUG", False)
+    SUMMARIZE_HISTORY = st.secrets.get("SUMMARIZE_HISTORY", False)
 
 except KeyError as e:
     st.error(f"ERROR: Missing secret: {e}.")
@@ -31,37 +67,39 @@ except KeyError as e:
 # --- THIS IS THE NEW DEBUG BOX ---
 # --- 
 # --- 
-st.header("Admin: Final Sanity Check")
-st.warning("Please verify these 3 values *exactly*.")
-with st.container(border=True):
-    try:
-        st.markdown(f"""
-        **1. Project ID:**
+# Only shown when DEBUG = true is set in secrets
+if DEBUG:
+    st.header("Admin: Final Sanity Check")
+    st.warning("Please verify these 3 values *exactly*.")
+    with st.container(border=True):
+        try:
+            st.markdown(f"""
+            **1. Project ID:**
         
-        `{SERVICE_ACCOUNT_JSON['project_id']}`
+            `{PROJECT_ID}`
         
-        *Is this the project where you enabled the Drive & Sheets APIs?*
-        """)
+            *Is this the project where you enabled the Drive & Sheets APIs?*
+            """)
         
-        st.markdown(f"""
-        **2. Service Account Email:**
+            st.markdown(f"""
+            **2. Service Account Email:**
         
-        `{SERVICE_ACCOUNT_JSON['client_email']}`
+            `{CLIENT_EMAIL}`
         
-        *Did you share your Google Sheet with this exact email?*
-        """)
+            *Did you share your Google Sheet with this exact email?*
+            """)
         
-        st.markdown(f"""
-        **3. Sheet ID the App is Using:**
+            st.markdown(f"""
+            **3. Sheet ID the App is Using:**
         
-        `{SHEET_ID}`
+            `{SHEET_ID}`
         
-        *Does this match the ID in your sheet's URL perfectly? (No spaces, no extra chars)*
-        """)
-    except Exception as e:
-        st.error(f"Could not read secrets, check formatting: {e}")
+            *Does this match the ID in your sheet's URL perfectly? (No spaces, no extra chars)*
+            """)
+        except Exception as e:
+            st.error(f"Could not read secrets, check formatting: {e}")
 
-st.divider()
+    st.divider()
 # --- 
 # --- 
 # --- END OF DEBUG BOX ---
@@ -74,54 +112,191 @@ st.divider()
 
 @st.cache_resource
 def setup_google_sheets_client():
+    # Heavy Google client imports are deferred to the cached warmup so the
+    # first render does not wait on them
+    import gspread
+    from google.oauth2.service_account import Credentials
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
     try:
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive.file"
-        ]
         creds = Credentials.from_service_account_info(
             SERVICE_ACCOUNT_JSON,
-            scopes=scopes
+            scopes=GS_SCOPES
         )
         client = gspread.authorize(creds)
+        # Reuse pooled keep-alive connections instead of a TLS handshake per call.
+        # Mount on gspread's own AuthorizedSession so auth headers are kept.
+        session = getattr(client, "http_client", client).session
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        )
+        session.mount("https://sheets.googleapis.com", adapter)
+        session.mount("https://www.googleapis.com", adapter)
         return client
     except Exception as e:
         st.error(f"Failed to authorize Google Sheets: {e}")
         return None
 
-def log_chat_to_sheet(client, user_message, bot_response):
-    if client is None: return
+@st.cache_resource
+def get_worksheet(_client):
+    if _client is None: return None
+    import gspread
     try:
         # Try to open by the unique ID first
-        sheet = client.open_by_key(SHEET_ID).sheet1
-        
+        return _client.open_by_key(SHEET_ID).sheet1
     except Exception as e:
         st.error(f"Error opening sheet by ID. Trying by name... Error: {e}")
+        # Failures raise rather than return None: st.cache_resource doesn't
+        # cache exceptions, so the next rerun tries again
         try:
-            sheet = client.open(SHEET_NAME).sheet1
-        except gspread.exceptions.SpreadsheetNotFound:
-            st.error(f"Error: Spreadsheet '{SHEET_NAME}' not found. Check name and sharing.")
-            return
-        except Exception as e_name:
-            st.error(f"Error opening sheet by name: {e_name}")
-            return
+            return _client.open(SHEET_NAME).sheet1
+        except gspread.exceptions.SpreadsheetNotFound as e_name:
+            raise RuntimeError(f"Spreadsheet '{SHEET_NAME}' not found. Check name and sharing.") from e_name
 
+class ResponseCache:
+    """Bounded, TTL'd cache of replies keyed on the normalized prompt."""
+
+    def __init__(self, ttl=3600, max_entries=512):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(prompt_text):
+        return prompt_text.strip().lower()
+
+    def get(self, prompt_text):
+        with self.lock:
+            entry = self.entries.get(self._key(prompt_text))
+        if entry is None or entry[0] < time.monotonic(): return None
+        return entry[1]
+
+    def put(self, prompt_text, bot_response):
+        with self.lock:
+            key = self._key(prompt_text)
+            self.entries[key] = (time.monotonic() + self.ttl, bot_response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+@st.cache_resource
+def configure_genai():
+    # Kept apart from get_gemini_model so edits there don't re-run configure.
+    # A module-level flag wouldn't work: Streamlit re-executes this file on rerun.
+    import google.generativeai as genai
+
+    # REST skips the gRPC channel setup, which dominates at this app's volume
+    genai.configure(api_key=GEMINI_API_KEY, transport="rest")
+    return genai
+
+def can_cache_system_prompt():
+    # Skips a CachedContent.create that is bound to fail for a short prompt.
+    # Any error here just means no caching, never a broken model.
     try:
-        timestamp = datetime.now().isoformat()
-        sheet.append_row([timestamp, user_message, bot_response])
-    except Exception as e_append:
-        st.error(f"Error appending row to sheet: {e_append}")
+        return get_system_prompt_tokens() >= CONTEXT_CACHE_MIN_TOKENS
+    except Exception as e:
+        logger.warning("Could not count SYSTEM_PROMPT tokens, skipping context caching: %s", e)
+        return False
+
+def renew_context_cache(cached, model_ref):
+    # Push the expiry out well before it lapses, for as long as some chat
+    # still holds the model; once the process exits it expires on its own
+    while True:
+        time.sleep(CONTEXT_CACHE_TTL.total_seconds() * 0.75)
+        try:
+            if model_ref() is None:
+                # Superseded model with no chats left, stop paying for storage
+                cached.delete()
+                return
+            cached.update(ttl=CONTEXT_CACHE_TTL)
+        except Exception as e:
+            logger.error("Error renewing Gemini context cache: %s", e)
 
 @st.cache_resource
 def get_gemini_model():
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel("models/gemini-pro-latest")
+        genai = configure_genai()
+        if not can_cache_system_prompt():
+            return genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=SYSTEM_PROMPT)
+
+        try:
+            # Prefill SYSTEM_PROMPT once server-side instead of on every turn
+            cached = genai.caching.CachedContent.create(
+                model=GEMINI_MODEL_NAME,
+                system_instruction=SYSTEM_PROMPT,
+                ttl=CONTEXT_CACHE_TTL
+            )
+        except Exception as e_cache:
+            logger.warning("Context caching unavailable, using system_instruction: %s", e_cache)
+            return genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=SYSTEM_PROMPT)
+
+        model = genai.GenerativeModel.from_cached_content(cached_content=cached)
+        # Only a weak reference, so the thread can tell when the model is unused
+        threading.Thread(
+            target=renew_context_cache, args=(cached, weakref.ref(model)), daemon=True
+        ).start()
         return model
     except Exception as e:
         st.error(f"Error setting up Gemini model: {e}")
         return None
 
+@st.cache_resource
+def get_token_counter():
+    # No system_instruction or cached content, which count_tokens would
+    # otherwise fold into every count
+    return configure_genai().GenerativeModel(GEMINI_MODEL_NAME)
+
+@st.cache_resource
+def get_system_prompt_tokens():
+    # SYSTEM_PROMPT never changes, so count it once instead of on every turn
+    return get_token_counter().count_tokens(SYSTEM_PROMPT).total_tokens
+
+def count_prompt_tokens(prompt_text):
+    # Approximation: ignores the few tokens of turn formatting between the two
+    return get_system_prompt_tokens() + get_token_counter().count_tokens(prompt_text).total_tokens
+
+def trim_chat_history(model, chat, history, window=HISTORY_WINDOW):
+    # Bounds both the displayed history and the ChatSession context, which is
+    # resent to Gemini on every turn
+    if len(history) <= window: return history
+
+    summary = None
+    if SUMMARIZE_HISTORY:
+        # Fold the older half into one summary so this runs every window/2
+        # messages rather than on every turn
+        earlier = history[:-(window // 2)]
+        transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in earlier)
+        try:
+            summary = model.generate_content(
+                f"Summarize this conversation in one paragraph:\n\n{transcript}"
+            ).text
+        except Exception as e:
+            st.error(f"Error summarizing chat history: {e}")
+
+    # keep is even, so the trimmed ChatSession history still starts on a user turn
+    keep = window // 2 if summary else window
+    if summary is None:
+        chat.history = chat.history[-keep:]
+        return history[-keep:]
+
+    chat.history = [
+        {"role": "user", "parts": [f"Summary of our conversation so far: {summary}"]},
+        {"role": "model", "parts": ["Understood, I'll keep that in mind."]}
+    ] + chat.history[-keep:]
+    return [{"role": "assistant", "content": f"*Earlier in this conversation:* {summary}"}] + history[-keep:]
+
+@st.cache_resource
+def get_sheet_logger(_worksheet):
+    return start_sheet_logger(_worksheet)
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache()
+
 # -----------------------------------------------------------------
 # 3. STREAMLIT APP UI - Chat Interface
 # -----------------------------------------------------------------
@@ -130,35 +305,101 @@ st.title("🧠 Dr. Huberman AI")
 
 gs_client = setup_google_sheets_client()
 gemini_model = get_gemini_model()
+try:
+    worksheet = get_worksheet(gs_client)
+except Exception as e:
+    st.error(f"Error opening sheet: {e}")
+    worksheet = None
+# get_sheet_logger caches on first call, so only build it with a real worksheet
+sheet_logger = get_sheet_logger(worksheet) if worksheet is not None else None
+response_cache = get_response_cache()
 
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
+def render_history(history, full_view=False):
+    if full_view or len(history) <= COMPACT_HISTORY_AFTER:
+        for role, content in history:
+            with st.chat_message(role):
+                st.markdown(content)
+        return
+
+    # One element per role instead of one per message keeps the rerun delta
+    # small; built from history so it stays in step with trim_chat_history
+    for role in ("user", "assistant"):
+        with st.chat_message(role):
+            st.markdown("\n\n---\n\n".join(content for r, content in history if r == role))
 
-for msg in st.session_state.chat_history:
-    with st.chat_message(msg["role"]):
-        st.markdown(msg["content"])
+# Debug-only escape hatch back to one element per message
+full_history_view = DEBUG and st.sidebar.toggle("Full history view", value=False)
+render_history(
+    tuple((msg["role"], msg["content"]) for msg in st.session_state.chat_history),
+    full_view=full_history_view
+)
 
 if prompt := st.chat_input("Ask about neuroscience, habits, or health:"):
     
-    if gemini_model is None or gs_client is None:
+    if gemini_model is None or gs_client is None or worksheet is None:
         st.error("Backend services not initialized. Cannot process request.")
         st.stop()
 
-    st.session_state.chat_history.append({"role": "user", "content": prompt})
+    if "chat" not in st.session_state:
+        st.session_state.chat = gemini_model.start_chat(history=[])
+    # Last good context, to restore if this turn's stream breaks
+    prior_history = list(st.session_state.chat.history)
+
+    user_entry = {"role": "user", "content": prompt}
+    st.session_state.chat_history.append(user_entry)
     with st.chat_message("user"):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            try:
-                full_prompt = f"{SYSTEM_PROMPT}\n\nUser: {prompt}\nAssistant:"
-                response = gemini_model.generate_content(full_prompt)
-                bot_response = response.text
-                
+        try:
+            # Replies only depend on the prompt alone on a session's first turn
+            first_turn = not prior_history
+            bot_response = response_cache.get(prompt) if first_turn else None
+
+            if bot_response is not None:
                 st.markdown(bot_response)
-                st.session_state.chat_history.append({"role": "assistant", "content": bot_response})
-                
-                log_chat_to_sheet(gs_client, prompt, bot_response)
-                
-            except Exception as e:
-                st.error(f"Error generating response from Gemini: {e}")
\ No newline at end of file
+                # Seed the chat so follow-up turns still have this exchange as context
+                st.session_state.chat.history = [
+                    {"role": "user", "parts": [prompt]},
+                    {"role": "model", "parts": [bot_response]}
+                ]
+            else:
+                # Spinner only covers the wait for the first chunk
+                with st.spinner("Thinking..."):
+                    stream = st.session_state.chat.send_message(prompt, stream=True)
+                bot_response = st.write_stream(chunk.text for chunk in stream)
+                # A stream that ended early (e.g. RECITATION after some text)
+                # only raises once history is read; do it here so the except
+                # below rebuilds the chat instead of the next turn crashing
+                st.session_state.chat.history
+                if first_turn:
+                    response_cache.put(prompt, bot_response)
+            
+            st.session_state.chat_history.append({"role": "assistant", "content": bot_response})
+            
+            sheet_logger.enqueue(st.session_state.session_id, prompt, bot_response)
+
+            st.session_state.chat_history = trim_chat_history(
+                gemini_model, st.session_state.chat, st.session_state.chat_history
+            )
+
+            # Last, so a failing count_tokens call can't skip logging or trimming
+            if DEBUG:
+                st.caption(
+                    f"~{count_prompt_tokens(prompt)} tokens for system prompt + message; "
+                    "the actual request also resends the chat history"
+                )
+            
+        except Exception as e:
+            st.error(f"Error generating response from Gemini: {e}")
+            if st.session_state.chat_history and st.session_state.chat_history[-1] is user_entry:
+                # No reply made it into history. A blocked or broken stream
+                # leaves the ChatSession raising on every later turn, so rebuild
+                # it from the last good context and drop the unanswered prompt
+                st.session_state.chat = gemini_model.start_chat(history=prior_history)
+                st.session_state.chat_history.pop()
\ No newline at end of file
@@ -0,0 +1,176 @@
+import asyncio
+import atexit
+import collections
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+# Same statuses the gspread session retries on (see setup_google_sheets_client)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class SheetLogger:
+    """Appends chat rows to the sheet from a background event loop, in batches."""
+
+    def __init__(self, worksheet, max_batch=32, max_retries=3, backoff_factor=0.3,
+                 dedupe_window=10.0, dedupe_size=64):
+        self.worksheet = worksheet
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.dedupe_window = dedupe_window
+        self.dedupe_size = dedupe_size
+        self.recent = collections.OrderedDict()
+        self.recent_lock = threading.Lock()
+        self.run_task = None
+        self.run_future = None
+        self.loop = asyncio.new_event_loop()
+        self.queue = asyncio.Queue()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        if worksheet is not None:
+            # Both gspread 5 and 6 keep the google-auth credentials on .client.auth
+            self.creds = worksheet.client.auth
+            range_name = quote(f"'{worksheet.title}'!A:C")
+            self.append_url = (
+                f"https://sheets.googleapis.com/v4/spreadsheets/{worksheet.spreadsheet.id}"
+                f"/values/{range_name}:append"
+            )
+            self.run_future = asyncio.run_coroutine_threadsafe(self._run(), self.loop)
+            self.run_future.add_done_callback(self._on_run_done)
+
+    def _on_run_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Sheet logger stopped, chats will not be logged: %s", future.exception())
+
+    def _running(self):
+        return self.run_future is not None and not self.run_future.done()
+
+    def _is_replay(self, session_id, user_message, bot_response):
+        # Keyed per session: two users can legitimately produce the same
+        # exchange (e.g. both served from the response cache), and dropping
+        # a real row is worse than writing a duplicate. A browser refresh
+        # starts a new session, so it can't be caught here.
+        digest = hashlib.blake2b(
+            f"{session_id}\0{user_message}\0{bot_response}".encode(), digest_size=8
+        ).digest()
+        now = time.monotonic()
+        with self.recent_lock:
+            seen = self.recent.pop(digest, None)
+            self.recent[digest] = now
+            while len(self.recent) > self.dedupe_size:
+                self.recent.popitem(last=False)
+        return seen is not None and now - seen < self.dedupe_window
+
+    def enqueue(self, session_id, user_message, bot_response):
+        if not self._running(): return
+        if self._is_replay(session_id, user_message, bot_response): return
+        # Timestamps are formatted per batch on the logger thread
+        self.loop.call_soon_threadsafe(
+            self.queue.put_nowait, (time.time_ns(), user_message, bot_response)
+        )
+
+    async def _drain(self):
+        # Wait for one row, then take whatever else queued up behind it
+        batch = [await self.queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _token(self):
+        if not self.creds.valid:
+            from google.auth.transport.requests import Request
+            # refresh() is blocking HTTP, keep it off the event loop
+            await self.loop.run_in_executor(None, self.creds.refresh, Request())
+        return self.creds.token
+
+    async def _append(self, batch):
+        rows = [
+            [datetime.fromtimestamp(ns / 1e9).isoformat(), user_message, bot_response]
+            for ns, user_message, bot_response in batch
+        ]
+        try:
+            await self._post(rows)
+        except Exception as e_append:
+            # Runs off the script thread, so st.error has nowhere to render.
+            logger.error("Error appending %d row(s) to sheet, dropping them: %s", len(rows), e_append)
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    async def _post(self, rows):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff_factor * 2 ** (attempt - 1))
+            try:
+                async with self.session.post(
+                    self.append_url,
+                    params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+                    headers={"Authorization": f"Bearer {await self._token()}"},
+                    json={"values": rows}
+                ) as resp:
+                    resp.raise_for_status()
+                return
+            except Exception as e:
+                # Other 4xx won't succeed on a retry; network errors might
+                status = getattr(e, "status", None)
+                if attempt == self.max_retries or (status is not None and status not in RETRY_STATUSES):
+                    raise
+                logger.warning("Retrying append of %d row(s) after error: %s", len(rows), e)
+
+    async def _run(self):
+        import aiohttp
+
+        self.run_task = asyncio.current_task()
+        # Cancelling the task in _stop exits this block and closes the session
+        async with aiohttp.ClientSession() as self.session:
+            while True:
+                # One POST in flight at a time: rows arriving meanwhile pile up and
+                # go out together in the next batch, and land in the sheet in order
+                await self._append(await self._drain())
+
+    async def _stop(self):
+        if self.run_task is not None:
+            self.run_task.cancel()
+            await asyncio.gather(self.run_task, return_exceptions=True)
+
+    def flush(self, timeout=10):
+        # Nothing drains the queue once _run has died, so don't wait on it
+        if not self._running(): return
+        # join() also covers rows already drained but still being posted
+        asyncio.run_coroutine_threadsafe(self.queue.join(), self.loop).result(timeout)
+
+    def close(self, timeout=10):
+        try:
+            self.flush(timeout)
+        except Exception as e:
+            logger.error("Error flushing sheet logger: %s", e)
+        try:
+            asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result(timeout)
+        except Exception as e:
+            logger.error("Error stopping sheet logger: %r", e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+# Unlike app.py, which Streamlit re-executes on every rerun, this module is
+# imported once per process, so it can track the logger that is live
+_current = None
+
+def start_sheet_logger(worksheet):
+    """Starts a SheetLogger, closing the one it replaces (e.g. after a cache clear)."""
+    global _current
+    if _current is not None:
+        _current.close()
+    _current = SheetLogger(worksheet)
+    return _current
+
+@atexit.register
+def _close_current():
+    if _current is not None:
+        _current.close()